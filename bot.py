@@ -11,13 +11,67 @@ TelegramDock - Telegram机器人系统
 """
 
 import os
+import re
 import json
+import time
+import random
+import asyncio
 import logging
 import configparser
+from collections import Counter, OrderedDict
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.error import TelegramError, BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes, CallbackQueryHandler
+
+class MessageIndex:
+    """管理员聊天中的消息ID到用户ID的映射，按最近使用淘汰并带过期时间"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # 消息ID -> (用户ID, 记录时间)，按最近使用排序
+        self.entries = OrderedDict()
+        self.dirty = False
+
+    def add(self, message_id, user_id):
+        """记录一条消息对应的用户"""
+        self.entries[message_id] = (user_id, time.time())
+        self.entries.move_to_end(message_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def get(self, message_id):
+        """查找消息对应的用户，不存在或已过期时返回None"""
+        item = self.entries.get(message_id)
+        if item is None:
+            return None
+
+        user_id, created = item
+        if time.time() - created > self.ttl:
+            del self.entries[message_id]
+            self.dirty = True
+            return None
+
+        # 只调整内存中的淘汰顺序，不触发保存；保存的顺序稍有滞后不影响使用
+        self.entries.move_to_end(message_id)
+        return user_id
+
+    def dump(self):
+        """导出为可保存的列表（从旧到新）"""
+        return [[message_id, user_id, created] for message_id, (user_id, created) in self.entries.items()]
+
+    def load(self, items):
+        """从保存的列表恢复，跳过已过期的记录"""
+        now = time.time()
+        for message_id, user_id, created in items:
+            if now - created <= self.ttl:
+                self.entries[message_id] = (user_id, created)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
 
 class TelegramBot:
     def __init__(self):
@@ -39,6 +93,23 @@ class TelegramBot:
         self.setup_logging()
         self.setup_directories()
         
+        # 加载待重试的发件箱和最近已送达消息的去重键
+        self.outbox = []
+        self.outbox_keys = set()
+        self.outbox_blocking = Counter()
+        pending, self.delivered_keys = self.load_outbox()
+        for entry in pending:
+            self.outbox_add(entry)
+        self.outbox_dirty = False
+        self.outbox_offline = False
+        self.outbox_offline_failures = 0
+        self.outbox_probe_at = 0
+        self.outbox_wakeup = None
+        self.outbox_task = None
+        
+        # 加载转发消息索引（用于管理员直接回复转发的消息）
+        self.reply_index = self.load_reply_index()
+        
     def check_and_create_config(self):
         """检查并创建配置文件，返回配置是否完整"""
         config_path = 'config/config.ini'
@@ -104,6 +175,8 @@ start_message = 欢迎使用TelegramDock智能客服系统！
 forward_success = 📨 您的消息已成功转发给客服人员，我们会尽快回复您！
 # 消息转发失败提示
 forward_failed = ❌ 消息转发失败，请稍后重试或联系技术支持。
+# 消息暂时无法送达、已进入重试队列时的提示
+forward_queued = ⏳ 网络繁忙，您的消息已保存，将在恢复后自动转发给客服人员。
 
 [logging]
 # 日志级别: DEBUG, INFO, WARNING, ERROR, CRITICAL
@@ -122,6 +195,36 @@ backup_count = 5
 user_data_file = config/data/users.json
 # 消息日志文件路径
 message_log_file = config/data/messages.json
+# 发件箱文件路径（发送失败的消息会保存在这里等待重试）
+outbox_file = config/data/outbox.json
+# 死信文件路径（无法送达或超过最大重试次数的消息会保存在这里，不会丢失）
+outbox_dead_file = config/data/outbox_dead.json
+# 转发消息索引文件路径（记录管理员收到的消息属于哪个用户）
+reply_index_file = config/data/reply_index.json
+
+[outbox]
+# 后台重试检查间隔 (秒)
+retry_interval = 10
+# 首次重试延迟 (秒)，之后按指数退避
+retry_base_delay = 5
+# 最大重试延迟 (秒)
+retry_max_delay = 600
+# 单条消息最大重试次数，超过后移入死信文件
+max_attempts = 50
+# 单条消息连续失败达到该次数后，不再阻塞同一聊天中后续的消息
+blocking_attempts = 5
+# 每批最多发送的消息数量
+batch_size = 20
+# 记录最近已送达消息的去重键数量，避免同一条消息重复发送
+delivered_keys = 1000
+# 发件箱最多保存的消息数量，超过后新消息直接移入死信文件
+max_pending = 10000
+
+[reply_index]
+# 最多记录的转发消息数量，超过后淘汰最久未使用的记录
+max_entries = 10000
+# 记录保留时间 (小时)，过期后无法再直接回复
+ttl_hours = 168
 """
         
         with open(config_path, 'w', encoding='utf-8') as f:
@@ -153,6 +256,16 @@ message_log_file = config/data/messages.json
             self.logger.error(f"加载配置失败: {e}")
             self.bot_token = None
             self.admin_id = None
+        
+        # 发件箱配置（旧配置文件中没有这些项时使用默认值）
+        self.outbox_retry_interval = self.config.getint('outbox', 'retry_interval', fallback=10)
+        self.outbox_retry_base_delay = self.config.getint('outbox', 'retry_base_delay', fallback=5)
+        self.outbox_retry_max_delay = self.config.getint('outbox', 'retry_max_delay', fallback=600)
+        self.outbox_max_attempts = self.config.getint('outbox', 'max_attempts', fallback=50)
+        self.outbox_blocking_attempts = self.config.getint('outbox', 'blocking_attempts', fallback=5)
+        self.outbox_batch_size = self.config.getint('outbox', 'batch_size', fallback=20)
+        self.outbox_max_delivered_keys = self.config.getint('outbox', 'delivered_keys', fallback=1000)
+        self.outbox_max_pending = self.config.getint('outbox', 'max_pending', fallback=10000)
     
     def setup_logging(self):
         """设置日志系统"""
@@ -281,7 +394,407 @@ message_log_file = config/data/messages.json
         user_data[user_id] = user_info
         self.save_user_data(user_data)
         return user_info
-    
+
+    def load_outbox(self):
+        """加载发件箱，返回 (待发送消息列表, 已送达去重键)
+
+        先读取完整保存的发件箱，再补上之后追加写入日志文件的新消息。
+        """
+        outbox_file = self.config.get('data', 'outbox_file', fallback='config/data/outbox.json')
+        pending = []
+        delivered_keys = OrderedDict()
+        try:
+            if os.path.exists(outbox_file):
+                with open(outbox_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                # 兼容只保存待发送列表的旧格式
+                if isinstance(data, list):
+                    pending = data
+                else:
+                    pending = data.get('pending', [])
+                    delivered_keys.update((key, None) for key in data.get('delivered', []))
+        except Exception as e:
+            self.logger.error(f"加载发件箱失败: {e}")
+
+        journal_file = f"{outbox_file}.journal"
+        try:
+            if os.path.exists(journal_file):
+                keys = {entry['key'] for entry in pending}
+                with open(journal_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # 写入中断的不完整记录
+                            continue
+                        if entry['key'] not in keys and entry['key'] not in delivered_keys:
+                            pending.append(entry)
+                            keys.add(entry['key'])
+        except Exception as e:
+            self.logger.error(f"加载发件箱日志失败: {e}")
+        return pending, delivered_keys
+
+    def append_outbox_journal(self, entry):
+        """把新入队的消息追加写入发件箱日志文件，不必每次重写整个发件箱"""
+        outbox_file = self.config.get('data', 'outbox_file', fallback='config/data/outbox.json')
+        try:
+            with open(f"{outbox_file}.journal", 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+        except Exception as e:
+            self.logger.error(f"写入发件箱日志失败: {e}")
+            self.save_outbox()
+
+    def save_outbox(self):
+        """保存发件箱（先写临时文件再替换，避免写入中断导致数据丢失）"""
+        outbox_file = self.config.get('data', 'outbox_file', fallback='config/data/outbox.json')
+        tmp_file = f"{outbox_file}.tmp"
+        data = {'pending': self.outbox, 'delivered': list(self.delivered_keys)}
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_file, outbox_file)
+            self.outbox_dirty = False
+            # 完整保存后日志中的记录已包含在发件箱文件中
+            if os.path.exists(f"{outbox_file}.journal"):
+                os.remove(f"{outbox_file}.journal")
+        except Exception as e:
+            self.logger.error(f"保存发件箱失败: {e}")
+
+    def load_reply_index(self):
+        """加载转发消息索引"""
+        max_entries = self.config.getint('reply_index', 'max_entries', fallback=10000)
+        ttl = self.config.getfloat('reply_index', 'ttl_hours', fallback=168) * 3600
+        reply_index = MessageIndex(max_entries, ttl)
+
+        reply_index_file = self.config.get('data', 'reply_index_file', fallback='config/data/reply_index.json')
+        try:
+            if os.path.exists(reply_index_file):
+                with open(reply_index_file, 'r', encoding='utf-8') as f:
+                    reply_index.load(json.load(f))
+        except Exception as e:
+            self.logger.error(f"加载转发消息索引失败: {e}")
+        return reply_index
+
+    def save_reply_index(self):
+        """保存转发消息索引"""
+        if not self.reply_index.dirty:
+            return
+
+        reply_index_file = self.config.get('data', 'reply_index_file', fallback='config/data/reply_index.json')
+        tmp_file = f"{reply_index_file}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.reply_index.dump(), f, separators=(',', ':'))
+            os.replace(tmp_file, reply_index_file)
+            self.reply_index.dirty = False
+        except Exception as e:
+            self.logger.error(f"保存转发消息索引失败: {e}")
+
+    def mark_delivered(self, key):
+        """记录已送达消息的去重键，只保留最近的 delivered_keys 条"""
+        self.delivered_keys[key] = None
+        self.delivered_keys.move_to_end(key)
+        while len(self.delivered_keys) > self.outbox_max_delivered_keys:
+            self.delivered_keys.popitem(last=False)
+        self.outbox_dirty = True
+
+    def dead_letter(self, entry, reason):
+        """将无法送达的消息保存到死信文件并移出发件箱，返回是否保存成功
+
+        只有死信文件写入成功后才移出发件箱；写入失败时消息留在发件箱中，
+        在 retry_max_delay 后再次尝试，保证消息不会丢失。
+        """
+        dead_file = self.config.get('data', 'outbox_dead_file', fallback='config/data/outbox_dead.json')
+        tmp_file = f"{dead_file}.tmp"
+        record = dict(entry, reason=reason, failed_at=datetime.now().isoformat())
+        try:
+            dead = []
+            if os.path.exists(dead_file):
+                with open(dead_file, 'r', encoding='utf-8') as f:
+                    dead = json.load(f)
+            dead.append(record)
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(dead, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, dead_file)
+        except Exception as e:
+            self.logger.error(f"保存死信消息失败，消息 {entry['key']} 保留在发件箱中: {e}")
+            entry['next_retry'] = time.time() + self.outbox_retry_max_delay
+            return False
+
+        if entry['key'] in self.outbox_keys:
+            self.outbox_remove(entry)
+        self.logger.error(f"发件箱消息 {entry['key']} 无法送达，已移入死信文件 {dead_file}: {reason}")
+        return True
+
+    def blocks_chat(self, entry):
+        """消息是否阻塞同一聊天中后续的消息
+
+        连续失败次数较少时保持顺序；达到 blocking_attempts 后认为该消息本身有问题，
+        让后续消息先发送，避免一条消息长期卡住整个管理员聊天。
+        """
+        return entry['attempts'] < self.outbox_blocking_attempts
+
+    def outbox_add(self, entry):
+        """加入发件箱并更新去重键和各聊天的阻塞计数"""
+        self.outbox.append(entry)
+        self.outbox_keys.add(entry['key'])
+        if self.blocks_chat(entry):
+            self.outbox_blocking[entry['chat_id']] += 1
+
+    def outbox_remove(self, entry):
+        """移出发件箱并更新去重键和各聊天的阻塞计数"""
+        self.outbox.remove(entry)
+        self.outbox_keys.discard(entry['key'])
+        if self.blocks_chat(entry):
+            self.outbox_blocking[entry['chat_id']] -= 1
+
+    def has_pending(self, chat_id):
+        """检查某个聊天是否还有会阻塞新消息的未送达消息"""
+        return self.outbox_blocking[chat_id] > 0
+
+    def enqueue_outbox(self, key, chat_id, op, **payload):
+        """将发送失败的消息加入发件箱，相同去重键的消息只保存一次
+
+        发件箱达到 max_pending 条时，新消息直接移入死信文件，避免无限增长。
+        """
+        if key in self.delivered_keys or key in self.outbox_keys:
+            return
+
+        entry = {
+            'key': key,
+            'chat_id': chat_id,
+            'op': op,
+            'attempts': 0,
+            'next_retry': 0
+        }
+        entry.update(payload)
+
+        if len(self.outbox) >= self.outbox_max_pending:
+            self.logger.error(f"发件箱已满 ({len(self.outbox)} 条)，消息 {key} 移入死信文件")
+            if self.dead_letter(entry, "发件箱已满"):
+                return
+
+        self.outbox_add(entry)
+        self.append_outbox_journal(entry)
+        self.logger.warning(f"消息 {key} 发送失败，已加入发件箱 (待发送: {len(self.outbox)})")
+
+    async def deliver(self, bot, chat_id, op, **payload):
+        """执行一次发送操作
+
+        payload 中带有 user_id 时，记录送达消息与该用户的对应关系，
+        管理员之后可以直接回复这条消息。
+        """
+        if op == 'send':
+            result = await bot.send_message(chat_id=chat_id, text=payload['text'])
+        elif op == 'forward':
+            result = await bot.forward_message(
+                chat_id=chat_id,
+                from_chat_id=payload['from_chat_id'],
+                message_id=payload['message_id']
+            )
+        elif op == 'copy':
+            result = await bot.copy_message(
+                chat_id=chat_id,
+                from_chat_id=payload['from_chat_id'],
+                message_id=payload['message_id']
+            )
+        else:
+            raise ValueError(f"未知的发件箱操作: {op}")
+
+        if payload.get('user_id'):
+            self.reply_index.add(result.message_id, payload['user_id'])
+        return result
+
+    async def send_or_enqueue(self, bot, key, chat_id, op, **payload):
+        """立即发送消息，失败时加入发件箱，返回是否已送达
+
+        同一聊天中如果还有未送达的消息，新消息直接排队，保证顺序。
+        最近已送达过的去重键（例如重启后Telegram重新推送的更新）不会再次发送。
+        BadRequest/Forbidden 属于重试也无法解决的错误，直接抛出。
+
+        注意：请求超时 (TimedOut) 时无法确定Telegram是否已收到消息，
+        此时消息仍会进入发件箱重试，管理员可能收到重复消息（至少送达一次）。
+        """
+        if key in self.delivered_keys:
+            self.logger.info(f"消息 {key} 已送达过，跳过重复发送")
+            return True
+
+        if self.has_pending(chat_id):
+            self.enqueue_outbox(key, chat_id, op, **payload)
+            return False
+
+        try:
+            await self.deliver(bot, chat_id, op, **payload)
+        except (BadRequest, Forbidden):
+            raise
+        except TelegramError as e:
+            self.logger.error(f"发送消息失败: {e}")
+            if isinstance(e, NetworkError):
+                self.mark_offline(e)
+            self.enqueue_outbox(key, chat_id, op, **payload)
+            return False
+
+        self.mark_delivered(key)
+        self.mark_online()
+        return True
+
+    async def note_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """网络断开期间收到更新时唤醒发件箱任务试发一次（仍受试发间隔限制）"""
+        if self.outbox_offline and self.outbox and self.outbox_wakeup:
+            self.outbox_wakeup.set()
+
+    def mark_offline(self, error):
+        """记录网络不可用，按指数退避安排下一次试发
+
+        网络错误不计入单条消息的重试次数，试发间隔最长为 retry_interval。
+        """
+        self.outbox_offline_failures += 1
+        if not self.outbox_offline:
+            self.logger.warning(f"网络不可用，发件箱暂停发送: {error}")
+        self.outbox_offline = True
+
+        delay = min(self.outbox_retry_interval, self.backoff_delay(self.outbox_offline_failures))
+        self.outbox_probe_at = time.time() + delay
+
+    def mark_online(self):
+        """消息成功送达后清除网络断开状态，并唤醒发件箱任务继续发送"""
+        if not self.outbox_offline:
+            return
+        self.outbox_offline = False
+        self.outbox_offline_failures = 0
+        if not self.outbox:
+            return
+
+        self.logger.info(f"网络已恢复，开始重试发件箱中的 {len(self.outbox)} 条消息")
+        if self.outbox_wakeup:
+            self.outbox_wakeup.set()
+
+    def backoff_delay(self, attempts):
+        """第 attempts 次失败后的指数退避延迟（带随机抖动）"""
+        delay = min(self.outbox_retry_max_delay, self.outbox_retry_base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def schedule_retry(self, entry):
+        """按指数退避（带随机抖动）安排下一次重试，超过最大次数返回False"""
+        was_blocking = self.blocks_chat(entry)
+        entry['attempts'] += 1
+        if was_blocking and not self.blocks_chat(entry):
+            self.outbox_blocking[entry['chat_id']] -= 1
+        if entry['attempts'] >= self.outbox_max_attempts:
+            return False
+
+        entry['next_retry'] = time.time() + self.backoff_delay(entry['attempts'])
+        return True
+
+    async def flush_outbox(self, bot):
+        """分批重试发件箱中到期的消息
+
+        每个聊天按入队顺序发送，队首消息未送达时跳过该聊天后续的消息；
+        消息只有在发送成功后才会移出发件箱（至少送达一次）。
+        网络错误不计入单条消息的重试次数：网络断开期间只在 mark_offline 安排的时间
+        试发，遇到网络错误立即停止本批次。
+        """
+        if not self.outbox:
+            return
+
+        now = time.time()
+        if self.outbox_offline and now < self.outbox_probe_at:
+            return
+
+        batch_size = self.outbox_batch_size
+        blocked_chats = set()
+        sent = 0
+        changed = False
+
+        for entry in list(self.outbox):
+            if sent >= batch_size:
+                break
+
+            chat_id = entry['chat_id']
+            if chat_id in blocked_chats:
+                continue
+            if entry['next_retry'] > now:
+                if self.blocks_chat(entry):
+                    blocked_chats.add(chat_id)
+                continue
+            if entry['key'] in self.delivered_keys:
+                self.outbox_remove(entry)
+                changed = True
+                continue
+            payload = {k: v for k, v in entry.items() if k not in ('key', 'chat_id', 'op', 'attempts', 'next_retry')}
+            try:
+                await self.deliver(bot, chat_id, entry['op'], **payload)
+            except RetryAfter as e:
+                # 触发限流，本批次剩余消息稍后再发（不计入重试次数）
+                entry['next_retry'] = time.time() + e.retry_after
+                changed = True
+                break
+            except (BadRequest, Forbidden) as e:
+                self.dead_letter(entry, str(e))
+                changed = True
+                continue
+            except NetworkError as e:
+                # 网络不可用，等待下次试发
+                self.mark_offline(e)
+                self.logger.warning(f"网络仍不可用，发件箱中 {len(self.outbox)} 条消息等待重试: {e}")
+                break
+            except Exception as e:
+                self.logger.error(f"重试发件箱消息 {entry['key']} 失败 (第 {entry['attempts'] + 1} 次): {e}")
+                if not self.schedule_retry(entry):
+                    self.dead_letter(entry, f"超过最大重试次数: {e}")
+                changed = True
+                if entry in self.outbox and self.blocks_chat(entry):
+                    blocked_chats.add(chat_id)
+                continue
+
+            self.outbox_remove(entry)
+            self.mark_delivered(entry['key'])
+            sent += 1
+            changed = True
+            self.mark_online()
+
+        if changed:
+            self.save_outbox()
+        if sent:
+            self.logger.info(f"发件箱已送达 {sent} 条消息，剩余 {len(self.outbox)} 条")
+
+    async def outbox_worker(self, application):
+        """后台发件箱重试任务"""
+        interval = self.outbox_retry_interval
+        while True:
+            try:
+                await self.flush_outbox(application.bot)
+            except Exception as e:
+                self.logger.error(f"发件箱重试任务出错: {e}")
+            if self.outbox_dirty:
+                self.save_outbox()
+            self.save_reply_index()
+
+            try:
+                await asyncio.wait_for(self.outbox_wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self.outbox_wakeup.clear()
+
+    async def start_outbox_worker(self, application):
+        """启动发件箱重试任务"""
+        if self.outbox:
+            self.logger.info(f"发件箱中有 {len(self.outbox)} 条待发送消息，将在后台重试")
+        self.outbox_wakeup = asyncio.Event()
+        self.outbox_task = asyncio.create_task(self.outbox_worker(application))
+
+    async def stop_outbox_worker(self, application):
+        """停止发件箱重试任务"""
+        if self.outbox_task:
+            self.outbox_task.cancel()
+            try:
+                await self.outbox_task
+            except asyncio.CancelledError:
+                pass
+            self.outbox_task = None
+        self.save_outbox()
+        self.save_reply_index()
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """处理 /start 命令"""
         user = update.effective_user
@@ -434,6 +947,22 @@ message_log_file = config/data/messages.json
             reply_markup=reply_markup
         )
 
+    async def reply_confirmation(self, message, text, user_id=None):
+        """发送确认消息
+
+        调用时消息已送达或已保存在发件箱中，确认消息发送失败只记录日志，
+        不能把已处理的消息当作发送失败。
+        给出 user_id 时记录确认消息对应的用户，管理员回复确认消息也能发送给该用户。
+        """
+        try:
+            result = await message.reply_text(text)
+        except TelegramError as e:
+            self.logger.error(f"发送确认消息失败: {e}")
+        else:
+            self.mark_online()
+            if user_id:
+                self.reply_index.add(result.message_id, user_id)
+
     async def forward_to_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """转发用户消息给管理员"""
         user = update.effective_user
@@ -486,26 +1015,39 @@ message_log_file = config/data/messages.json
 💬 消息内容：
 """
         
+        key = f"forward:{message.chat_id}:{message.message_id}"
+
         try:
             # 发送用户信息给管理员
-            await context.bot.send_message(
-                chat_id=self.admin_id,
-                text=user_info
+            header_sent = await self.send_or_enqueue(
+                context.bot, f"{key}:header", self.admin_id, 'send',
+                text=user_info, user_id=user.id
             )
-            
-            # 转发原始消息给管理员
-            await message.forward(chat_id=self.admin_id)
-            
-            # 给用户发送确认消息
-            success_message = self.config.get('messages', 'forward_success')
-            await message.reply_text(success_message)
-            
-            self.logger.info(f"已转发用户 {user.id} 的消息给管理员 {self.admin_id}")
-            
+
+            # 转发原始消息给管理员（头部未送达时会自动排在其后）
+            content_sent = await self.send_or_enqueue(
+                context.bot, f"{key}:content", self.admin_id, 'forward',
+                from_chat_id=message.chat_id, message_id=message.message_id, user_id=user.id
+            )
+
         except Exception as e:
             self.logger.error(f"转发消息失败: {e}")
             failed_message = self.config.get('messages', 'forward_failed')
             await message.reply_text(failed_message)
+            return
+
+        if header_sent and content_sent:
+            confirm_message = self.config.get('messages', 'forward_success')
+            self.logger.info(f"已转发用户 {user.id} 的消息给管理员 {self.admin_id}")
+        else:
+            confirm_message = self.config.get(
+                'messages', 'forward_queued',
+                fallback='⏳ 网络繁忙，您的消息已保存，将在恢复后自动转发给客服人员。'
+            )
+            self.logger.info(f"用户 {user.id} 的消息已加入发件箱，稍后转发给管理员 {self.admin_id}")
+
+        # 给用户发送确认消息
+        await self.reply_confirmation(message, confirm_message)
 
     async def handle_admin_reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """处理管理员回复用户的消息"""
@@ -513,35 +1055,75 @@ message_log_file = config/data/messages.json
             return
         
         message = update.message
+
+        # 明确写了 "@用户ID 消息内容" 时优先按该格式回复，即使是在回复某条消息
+        explicit = re.match(r'@(-?\d+)\s+(.+)', message.text, re.DOTALL) if message.text else None
+
+        # 直接回复转发的消息：根据索引找到用户，复制管理员的消息（支持任意类型）
+        # 索引只记录与管理员私聊中的消息ID，其他聊天中的回复不能使用索引
+        if message.reply_to_message and message.chat_id == self.admin_id and not explicit:
+            replied = message.reply_to_message
+            target_user_id = self.reply_index.get(replied.message_id)
+            if target_user_id is not None:
+                await self.handle_admin_native_reply(message, context, target_user_id)
+                return
+
+            # 只有回复转发的消息或用户信息头部时才提示记录已过期，回复其他消息保持原来的忽略行为
+            forwarded = replied.forward_date is not None or '📨 收到用户消息' in (replied.text or '')
+            if forwarded and not (message.text and message.text.startswith('@')):
+                await message.reply_text("❌ 未找到该消息对应的用户（记录可能已过期），请使用: @用户ID 消息内容")
+                return
+
         if not message.text:
             return
             
         # 检查是否是回复用户的格式: @用户ID 消息内容
-        if message.text.startswith('@'):
+        if explicit:
+            target_user_id = int(explicit.group(1))
+            reply_content = explicit.group(2)
             try:
-                parts = message.text.split(' ', 1)
-                if len(parts) >= 2:
-                    user_id_str = parts[0][1:]  # 移除@符号
-                    reply_content = parts[1]
-                    target_user_id = int(user_id_str)
-                    
-                    # 发送消息给目标用户
-                    await context.bot.send_message(
-                        chat_id=target_user_id,
-                        text=f"📨 客服回复：\n\n{reply_content}"
-                    )
-                    
-                    # 给管理员发送确认
-                    await message.reply_text(f"✅ 已回复用户 {target_user_id}")
-                    
+                # 发送消息给目标用户
+                sent = await self.send_or_enqueue(
+                    context.bot, f"reply:{message.chat_id}:{message.message_id}",
+                    target_user_id, 'send',
+                    text=f"📨 客服回复：\n\n{reply_content}"
+                )
+
+                # 给管理员发送确认
+                if sent:
+                    await self.reply_confirmation(message, f"✅ 已回复用户 {target_user_id}", target_user_id)
                     self.logger.info(f"管理员回复用户 {target_user_id}: {reply_content}")
-                    
-            except (ValueError, IndexError) as e:
-                await message.reply_text("❌ 回复格式错误，请使用: @用户ID 消息内容")
-                self.logger.error(f"管理员回复格式错误: {e}")
+                else:
+                    await self.reply_confirmation(message, f"⏳ 暂时无法送达用户 {target_user_id}，已加入发件箱自动重试", target_user_id)
+                    self.logger.info(f"管理员回复用户 {target_user_id} 已加入发件箱: {reply_content}")
+
             except Exception as e:
                 await message.reply_text(f"❌ 发送失败: {str(e)}")
                 self.logger.error(f"管理员回复发送失败: {e}")
+        elif message.text.startswith('@'):
+            await message.reply_text("❌ 回复格式错误，请使用: @用户ID 消息内容")
+            self.logger.error(f"管理员回复格式错误: {message.text[:50]}")
+
+    async def handle_admin_native_reply(self, message, context: ContextTypes.DEFAULT_TYPE, target_user_id) -> None:
+        """处理管理员直接回复转发消息"""
+        try:
+            sent = await self.send_or_enqueue(
+                context.bot, f"reply:{message.chat_id}:{message.message_id}",
+                target_user_id, 'copy',
+                from_chat_id=message.chat_id, message_id=message.message_id
+            )
+
+            # 给管理员发送确认
+            if sent:
+                await self.reply_confirmation(message, f"✅ 已回复用户 {target_user_id}", target_user_id)
+                self.logger.info(f"管理员回复用户 {target_user_id}: 消息 {message.message_id}")
+            else:
+                await self.reply_confirmation(message, f"⏳ 暂时无法送达用户 {target_user_id}，已加入发件箱自动重试", target_user_id)
+                self.logger.info(f"管理员回复用户 {target_user_id} 已加入发件箱: 消息 {message.message_id}")
+
+        except Exception as e:
+            await message.reply_text(f"❌ 发送失败: {str(e)}")
+            self.logger.error(f"管理员回复发送失败: {e}")
 
     async def handle_no_admin_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """处理未配置管理员时的消息"""
@@ -613,9 +1195,17 @@ message_log_file = config/data/messages.json
             
         try:
             # 创建应用
-            application = Application.builder().token(self.bot_token).build()
+            application = (
+                Application.builder()
+                .token(self.bot_token)
+                .post_init(self.start_outbox_worker)
+                .post_stop(self.stop_outbox_worker)
+                .build()
+            )
             
             # 添加处理器
+            # 收到任何更新时检查网络是否已恢复（在其他处理器之前运行）
+            application.add_handler(TypeHandler(Update, self.note_update), group=-1)
             application.add_handler(CommandHandler("start", self.start))
             application.add_handler(CommandHandler("id", self.get_user_id))
             application.add_handler(CommandHandler("menu", self.show_menu))
@@ -624,7 +1214,7 @@ message_log_file = config/data/messages.json
             # 管理员消息处理器（仅在admin_id配置时添加）
             if self.admin_id:
                 application.add_handler(MessageHandler(
-                    filters.TEXT & filters.User(self.admin_id) & ~filters.COMMAND,
+                    filters.User(self.admin_id) & ~filters.COMMAND,
                     self.handle_admin_reply
                 ))
                 